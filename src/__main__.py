@@ -7,13 +7,26 @@
 # pylint: disable=line-too-long
 
 import os
+import ssl
 import sys
+import socket
 import time
 import logging
 import argparse
+import functools
 import configparser
-from datetime import datetime, UTC
+import http.cookiejar
 import urllib3
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.ssl_ import create_urllib3_context
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions
+
+# Created on first use by get_influx_write_api() / send_to_influx_udp()
+_influx_write_api = None
+_influx_udp_socket = None
 
 def main():
   """ MAIN """
@@ -31,11 +44,18 @@ def main():
   destination = config['destination']
   modem_model = config['modem_model']
 
+  # Returned by get_data when the modem reports nothing changed since the last interval,
+  # and how to make it forget the last page when that page didn't give us any stats
+  not_modified = None
+  forget_page = None
+
   if modem_model == 'sb8200':
     import arris_stats_sb8200
     get_credential = arris_stats_sb8200.get_credential
     get_data = arris_stats_sb8200.get_html
     parse_data = arris_stats_sb8200.parse_html
+    not_modified = arris_stats_sb8200.NOT_MODIFIED
+    forget_page = arris_stats_sb8200.forget_page
   elif modem_model == 's33':
     import arris_stats_s33
     get_credential = arris_stats_s33.get_credential
@@ -53,19 +73,35 @@ def main():
   if not config['modem_verify_ssl']:
     urllib3.disable_warnings()
 
+  # Keep one session for the life of the process so the connection to the
+  # modem stays open across the auth/fetch pair and across sleep intervals
+  session = get_session(config)
+
   credential = None
+  last_stats = None
+  unchanged_intervals = 0
+
+  # Poll on a fixed schedule rather than sleeping sleep_interval after each poll,
+  # otherwise every poll drifts later by however long the previous one took
+  next_poll = time.monotonic()
 
   first = True
   while True:
     if not first:
-      logging.info('Sleeping for %s seconds', sleep_interval)
-      sys.stdout.flush()
-      time.sleep(sleep_interval)
+      delay = next_poll - time.monotonic()
+      if delay > 0:
+        logging.info('Sleeping for %.1f seconds', delay)
+        sys.stdout.flush()
+        time.sleep(delay)
+      else:
+        # We fell a whole interval behind (e.g. waiting to authenticate), start the schedule again from now
+        next_poll = time.monotonic()
     first = False
+    next_poll += sleep_interval
 
     if config['modem_auth_required'] or modem_model == 's33' or modem_model == 'xb8':
       while not credential:
-        credential = get_credential(config)
+        credential = get_credential(config, session)
         if not credential and config['exit_on_auth_error']:
           error_exit('Unable to authenticate with modem. Exiting since exit_on_auth_error is True.', config)
         if not credential:
@@ -73,29 +109,49 @@ def main():
           time.sleep(sleep_interval)
           continue
 
-    # Get the HTML from the modem
-    data = get_data(config, credential)
-    if not data:
-      if config['exit_on_html_error']:
-        error_exit('No data obtained from modem. Exiting since exit_on_html_error is True.', config)
+    # Get the data from the modem
+    data = get_data(config, credential, session)
+
+    # The status page hasn't changed since the last interval so there's nothing new to parse,
+    # only resend the last stats every max_unchanged_intervals so there are no gaps in Grafana
+    if not_modified is not None and data is not_modified:
+      unchanged_intervals += 1
+      if unchanged_intervals < config['max_unchanged_intervals']:
+        logging.info('Stats unchanged since last interval, skipping')
+        continue
+      logging.info('Stats unchanged for %s intervals, resending the last stats', unchanged_intervals)
+      stats = last_stats
+    else:
+      # Not a truth test, the SB8200 returns an lxml element rather than a string
+      if data is None or len(data) == 0:
+        if config['exit_on_html_error']:
+          error_exit('No data obtained from modem. Exiting since exit_on_html_error is True.', config)
       
-      logging.error('No data to parse, giving up until next interval.')
-      if config['clear_auth_token_on_html_error']:
-        logging.info('clear_auth_token_on_html_error is true, clearing credential token.')
-        credential = None
-      continue
-
-    # Parse the HTML to get our stats
-    stats = parse_data(data)
-
-    if not stats or (not stats['upstream'] and not stats['downstream']):
-      logging.error(
-        'Failed to get any stats, giving up until next interval')
-      continue
+        logging.error('No data to parse, giving up until next interval.')
+        if config['clear_auth_token_on_html_error']:
+          logging.info('clear_auth_token_on_html_error is true, clearing credential token.')
+          credential = None
+        continue
+
+      # Parse the HTML to get our stats
+      stats = parse_data(data)
+
+      if not stats or (not stats['upstream'] and not stats['downstream']):
+        logging.error(
+          'Failed to get any stats, giving up until next interval')
+        # Only pages that gave us stats count as unchanged, so the same page is parsed (and reported) again
+        if forget_page:
+          forget_page()
+        continue
+
+    unchanged_intervals = 0
+    last_stats = stats
 
     # Where should 6we send the results?
     if destination == 'influxdb':
       send_to_influx(stats, config)
+    elif destination == 'influxdb_udp':
+      send_to_influx_udp(stats, config)
     else:
       error_exit('Destination %s not supported!  Aborting.' % destination, sleep=False)
 
@@ -108,41 +164,142 @@ def get_args():
   args = parser.parse_args()
   return args
 
+class ModemAdapter(HTTPAdapter):
+  """ HTTPAdapter that builds its SSL context once, rather than
+    urllib3 building a new one and reloading the CA bundle for
+    every connection
+  """
+  def __init__(self, verify_ssl, **kwargs):
+    self.verify_ssl = verify_ssl
+
+    # Set before HTTPAdapter.__init__(), which calls init_poolmanager().
+    # Built the same way urllib3 builds its own context, so modems that only offer the
+    # older ciphers in urllib3's DEFAULT_CIPHERS still work. urllib3 matches the hostname
+    # itself (the modem is usually addressed by IP, which the ssl module won't accept
+    # with check_hostname), so it's left off here
+    self.ssl_context = create_urllib3_context(cert_reqs=ssl.CERT_REQUIRED if verify_ssl else ssl.CERT_NONE)
+    self.ssl_context.check_hostname = False
+    if verify_ssl:
+      self.ssl_context.load_verify_locations(requests.certs.where())
+    super().__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    kwargs['ssl_context'] = self.ssl_context
+    return super().init_poolmanager(*args, **kwargs)
+
+  def cert_verify(self, conn, url, verify, cert):
+    # requests lets REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE override session.verify = False,
+    # make sure modem_verify_ssl wins
+    if not self.verify_ssl:
+      verify = False
+
+    super().cert_verify(conn, url, verify, cert)
+    # The CA bundle is already loaded in our context, don't have urllib3 load it again
+    if verify is True:
+      conn.ca_certs = None
+      conn.ca_cert_dir = None
+
+def get_session(config):
+  """ Build the requests session used for all modem requests """
+  session = requests.Session()
+  session.verify = config['modem_verify_ssl']
+
+  # Don't keep the cookies the modem sets, only send the ones each request passes
+  # explicitly, so dropping the credential really does start a fresh login
+  session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+  adapter = ModemAdapter(
+    config['modem_verify_ssl'],
+    pool_connections=2,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.5)
+  )
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+
+  return session
+
+def str_to_none(string):
+  """ Return None for the string 'None', otherwise the string itself """
+  if string == 'None':
+    return None
+  return string
+
+_BOOL_MAP = {
+  'true': True, 'True': True, 'TRUE': True,
+  'false': False, 'False': False, 'FALSE': False,
+}
+
+def str_to_bool(string, name):
+  """ Return True is string ~= 'true' """
+  try:
+    return _BOOL_MAP[string]
+  except KeyError:
+    pass
+
+  # Any other casing, like 'tRuE'
+  try:
+    return _BOOL_MAP[string.lower()]
+  except KeyError:
+    raise ValueError('Config parameter % s should be boolean "true" or "false", but value is neither of those.' % name) from None
+
+DEFAULT_CONFIG = {
+  # Main
+  'enable_debug': False,
+  'destination': 'influxdb',
+  'sleep_interval': 120,
+  'modem_ip': '192.168.100.1',
+  'modem_verify_ssl': False,
+  'modem_username': 'admin',
+  'modem_password': None,
+  'modem_model': 's33',
+  'exit_on_auth_error': True,
+  'exit_on_html_error': True,
+  'clear_auth_token_on_html_error': True,
+  'sleep_before_exit': True,
+  'request_timeout': 30,
+  'modem_connect_timeout': 3.05,
+
+  # SB8200 Only
+  'modem_ssl': False,
+  'modem_auth_required': False,
+  'modem_new_auth': False,
+  'max_unchanged_intervals': 5,
+
+  # InfluxDB
+  'influx_url': 'http://localhost:8086',
+  'influx_bucket': 'cable_modem_stats',
+  'influx_org': None,
+  'influx_token': None,
+  'influx_verify_ssl': True,
+  'influx_batch_size': 500,
+  'influx_flush_interval': 10,
+
+  # InfluxDB UDP
+  'influx_udp_host': 'localhost',
+  'influx_udp_port': 8089,
+}
+
+def get_coercer(param, default):
+  """ How to convert a string from config.ini or ENV, based on the type of the default value """
+  if isinstance(default, bool):
+    return functools.partial(str_to_bool, name=param)
+  if isinstance(default, int):
+    return int
+  if isinstance(default, float):
+    return float
+  if default is None:
+    return str_to_none
+  return str
+
+_COERCERS = {param: get_coercer(param, default) for param, default in DEFAULT_CONFIG.items()}
+
 def get_config(config_path=None):
   """ Grab config from the ini config file,
     then grab the same variables from ENV to override
   """
 
-  default_config = {
-    # Main
-    'enable_debug': False,
-    'destination': 'influxdb',
-    'sleep_interval': 120,
-    'modem_ip': '192.168.100.1',
-    'modem_verify_ssl': False,
-    'modem_username': 'admin',
-    'modem_password': None,
-    'modem_model': 's33',
-    'exit_on_auth_error': True,
-    'exit_on_html_error': True,
-    'clear_auth_token_on_html_error': True,
-    'sleep_before_exit': True,
-    'request_timeout': 30,
-
-    # SB8200 Only
-    'modem_ssl': False,
-    'modem_auth_required': False,
-    'modem_new_auth': False,
-
-    # InfluxDB
-    'influx_url': 'http://localhost:8086',
-    'influx_bucket': 'cable_modem_stats',
-    'influx_org': None,
-    'influx_token': None,
-    'influx_verify_ssl': True,
-  }
-
-  config = default_config.copy()
+  ini_config = {}
 
   # Get config from config.ini first
   if config_path:
@@ -153,113 +310,146 @@ def get_config(config_path=None):
     with open(config_path) as f:
       file_content = '[%s]\n' % section + f.read()
     parser.read_string(file_content)
+    ini_config = parser[section]
+
+  # ENV overrides anything we find in config.ini, then any string gets
+  # converted depending on the type of the default value
+  env = os.environ
+  config = {}
+  for param, default in DEFAULT_CONFIG.items():
+    value = env.get(param) or ini_config.get(param, default)
+    if isinstance(value, str):
+      value = _COERCERS[param](value)
+    config[param] = value
 
-    for param in default_config:
-      config[param] = parser[section].get(param, default_config[param])
-
-  # Get it from ENV now and override anything we find
-  for param in config:
-    if os.environ.get(param):
-      config[param] = os.environ.get(param)
-
-  # Special handling depending ontype
-  for param in config:
-    # If the default value is a boolean, but we have a string, convert it
-    if isinstance(default_config[param], bool) and isinstance(config[param], str):
-      config[param] = str_to_bool(string=config[param], name=param)
-
-    # If the default value is an int, but we have a string, convert it
-    if isinstance(default_config[param], int) and isinstance(config[param], str):
-      config[param] = int(config[param])
+  return config
 
-    # Finally any 'None' string should just be None
-    if default_config[param] is None and config[param] == 'None':
-      config[param] = None
+def get_influx_write_api(config):
+  """ Return the batching InfluxDB write api, creating the client on first use.
+    The client lives for the rest of the process and points are flushed in the
+    background once either the batch size or the flush interval is reached
+  """
+  global _influx_write_api # pylint: disable=global-statement
+
+  if _influx_write_api is None:
+    influx_client = InfluxDBClient(
+      url = config['influx_url'],
+      token = config['influx_token'],
+      org = config['influx_org'],
+      verify_ssl = config['influx_verify_ssl']
+    )
+    _influx_write_api = influx_client.write_api(
+      write_options = WriteOptions(
+        batch_size = config['influx_batch_size'],
+        flush_interval = config['influx_flush_interval'] * 1000,
+        jitter_interval = 2_000,
+        retry_interval = 5_000
+      ),
+      success_callback = influx_write_success,
+      error_callback = influx_write_error
+    )
+
+  return _influx_write_api
+
+def close_influx():
+  """ Flush anything still buffered and close the InfluxDB write api """
+  global _influx_write_api # pylint: disable=global-statement
+
+  if _influx_write_api is not None:
+    _influx_write_api.close()
+    _influx_write_api = None
+
+def influx_write_success(conf, data):
+  """ Called by the batching writer once a batch is written """
+  logging.info('Successfully wrote data to InfluxDB')
+  logging.debug('Influx batch sent to db (%s):', conf)
+  logging.debug(data)
 
-  return config
+def influx_write_error(conf, data, exception):
+  """ Called by the batching writer when a batch could not be written """
+  logging.error('Failed To Write To InfluxDB: %s', exception)
+  logging.debug('Influx batch not written to db (%s):', conf)
+  logging.debug(data)
 
 def send_to_influx(stats, config):
-  """ Send the stats to InfluxDB """
+  """ Queue the stats to be sent to InfluxDB """
   logging.info('Sending stats to InfluxDB (%s)', config['influx_url'])
 
-  from influxdb_client import InfluxDBClient, Point
-  from influxdb_client.client.write_api import SYNCHRONOUS
+  write_api = get_influx_write_api(config)
 
-  influx_client = InfluxDBClient(
-    url = config['influx_url'],
-    token = config['influx_token'],
-    org = config['influx_org'],
-    verify_ssl = config['influx_verify_ssl']
-  )
-  write_api = influx_client.write_api(write_options = SYNCHRONOUS)
+  # Stats are polled every sleep_interval seconds, so second precision is plenty.
+  # The records are handed over as they're built, the batching writer logs what it sends
+  series = get_line_protocol(stats, int(time.time()))
+
+  try:
+    write_api.write(bucket = config['influx_bucket'], record = series, write_precision = WritePrecision.S)
+  except Exception:
+    logging.exception('Failed To Write To InfluxDB')
 
-  series = []
-  current_time = datetime.now(UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+def send_to_influx_udp(stats, config):
+  """ Send the stats to an InfluxDB (or Telegraf) UDP listener.
+    There's no acknowledgement over UDP, so anything lost on the way is gone
+  """
+  global _influx_udp_socket # pylint: disable=global-statement
 
-  for stats_down in stats['downstream']:
-    data = {
-      'measurement': 'downstream_statistics',
-      'time': current_time,
-      'fields': {
-        'frequency': int(float(stats_down['frequency'])),
-        'power': float(stats_down['power']),
-        'snr': float(stats_down['snr']),
-        'corrected': int(stats_down['corrected']),
-        'uncorrectables': int(stats_down['uncorrectables'])
-      },
-      'tags': {
-        'channel_id': int(stats_down['channel_id']),
-        'modulation': stats_down['modulation']
-      }
-    }
-    ## Only some modems, like the XB8, has the 'unerrored' value
-    if 'unerrored' in stats_down:
-      data['fields']['unerrored'] = int(stats_down['unerrored'])
+  address = (config['influx_udp_host'], config['influx_udp_port'])
+  logging.info('Sending stats to InfluxDB UDP listener (%s:%s)', *address)
 
-    series.append(Point.from_dict(data))
+  if _influx_udp_socket is None:
+    _influx_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-  for stats_up in stats['upstream']:
-    series.append(Point.from_dict({
-      'measurement': 'upstream_statistics',
-      'time': current_time,
-      'fields': {
-        'frequency': int(float(stats_up['frequency'])),
-        'power': float(stats_up['power']),
-        'width': int(stats_up['width']),
-      },
-      'tags': {
-        'channel_id': int(stats_up['channel_id']),
-        'channel_type': stats_up['channel_type']
-      }
-    }))
+  # UDP listeners default to ns precision, keep the same second resolution as send_to_influx
+  series = '\n'.join(get_line_protocol(stats, int(time.time()) * 1_000_000_000))
 
   try:
-    write_api.write(bucket = config['influx_bucket'], record = series)
-  except Exception:
-    logging.exception('Failed To Write To InfluxDB')
+    _influx_udp_socket.sendto(series.encode('utf-8'), address)
+  except OSError:
+    logging.exception('Failed To Write To InfluxDB UDP listener')
     return
 
-  logging.info('Successfully wrote data to InfluxDB')
+  logging.info('Successfully sent data to InfluxDB UDP listener')
   logging.debug('Influx series sent to db:')
   logging.debug(series)
 
+def get_line_protocol(stats, timestamp):
+  """ Yield the InfluxDB line protocol records for the stats """
+  for stats_down in stats['downstream']:
+    line = (
+      f"downstream_statistics,channel_id={int(stats_down.channel_id)},modulation={escape_tag(stats_down.modulation)} "
+      f"frequency={int(float(stats_down.frequency))}i,"
+      f"power={float(stats_down.power)},"
+      f"snr={float(stats_down.snr)},"
+      f"corrected={int(stats_down.corrected)}i,"
+      f"uncorrectables={int(stats_down.uncorrectables)}i"
+    )
+    ## Only some modems, like the XB8, has the 'unerrored' value
+    if stats_down.unerrored is not None:
+      line += f",unerrored={int(stats_down.unerrored)}i"
+
+    yield f'{line} {timestamp}'
+
+  for stats_up in stats['upstream']:
+    yield (
+      f"upstream_statistics,channel_id={int(stats_up.channel_id)},channel_type={escape_tag(stats_up.channel_type)} "
+      f"frequency={int(float(stats_up.frequency))}i,"
+      f"power={float(stats_up.power)},"
+      f"width={int(stats_up.width)}i "
+      f"{timestamp}"
+    )
+
+def escape_tag(value):
+  """ Escape a tag value for line protocol """
+  return value.replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
 def error_exit(message, config=None, sleep=True):
   """ Log error, sleep if needed, then exit 1 """
   logging.error(message)
+  close_influx()
   if sleep and config and config['sleep_before_exit']:
     logging.info('Sleeping for %s seconds before exiting since sleep_before_exit is True', config['sleep_interval'])
     time.sleep(config['sleep_interval'])
   sys.exit(1)
 
-def str_to_bool(string, name):
-  """ Return True is string ~= 'true' """
-  if string.lower() == 'true':
-    return True
-  if string.lower() == 'false':
-    return False
-
-  raise ValueError('Config parameter % s should be boolean "true" or "false", but value is neither of those.' % name)
-
 def init_logger(debug=False):
   """ Start the python logger """
   log_format = '%(asctime)s %(levelname)-8s %(message)s'
@@ -5,9 +5,9 @@
 import time
 import hmac
 import logging
-import requests
+from channel_stats import DownstreamChannel, UpstreamChannel
 
-def get_credential(config):
+def get_credential(config, session):
   """ Get the cookie credential by sending the
     username and password pair for basic auth. They
     also want the pair as a base64 encoded get req param
@@ -42,12 +42,12 @@ def get_credential(config):
   # This is going to respond with our "credential", which is a hash that we
   # have to send as a cookie with subsequent requests
   try:
-    resp = requests.post(
+    resp = session.post(
       url=url,
       json=payload,
       headers=headers,
       verify=verify_ssl,
-      timeout=config['request_timeout']
+      timeout=(config['modem_connect_timeout'], config['request_timeout'])
     )
 
     if resp.status_code != 200:
@@ -81,12 +81,12 @@ def get_credential(config):
       f"PrivateKey={private_key}"
     )
 
-    resp = requests.post(
+    resp = session.post(
       url=url,
       json=payload,
       headers=headers,
       verify=verify_ssl,
-      timeout=config['request_timeout']
+      timeout=(config['modem_connect_timeout'], config['request_timeout'])
     )
 
     if resp.status_code != 200:
@@ -112,7 +112,7 @@ def get_credential(config):
   return { 'uid': uid, 'private_key': private_key }
 
 
-def get_json(config, credential):
+def get_json(config, credential, session):
   """ Get the status page from the modem
     return the raw html
   """
@@ -142,12 +142,12 @@ def get_json(config, credential):
   logging.info('Retreiving stats from %s', url)
 
   try:
-    resp = requests.post(
+    resp = session.post(
       url=url,
       json=payload,
       headers=headers,
       verify=verify_ssl,
-      timeout=config['request_timeout']
+      timeout=(config['modem_connect_timeout'], config['request_timeout'])
     )
     if resp.status_code != 200:
       logging.error('Error retreiving json from %s', url)
@@ -186,15 +186,15 @@ def parse_json(json):
       _,
     ) = channel.split("^")
 
-    stats['downstream'].append({
-      'channel_id': channel_id,
-      'modulation': modulation,
-      'frequency': frequency,
-      'power': power,
-      'snr': snr,
-      'corrected': corrected,
-      'uncorrectables': uncorrectables
-    })
+    stats['downstream'].append(DownstreamChannel(
+      channel_id=channel_id,
+      modulation=modulation,
+      frequency=frequency,
+      power=power,
+      snr=snr,
+      corrected=corrected,
+      uncorrectables=uncorrectables
+    ))
 
   logging.debug('downstream stats: %s', stats['downstream'])
   if not stats['downstream']:
@@ -213,13 +213,13 @@ def parse_json(json):
       power,
       _,
     ) = channel.split("^")
-    stats['upstream'].append({
-      'channel_id': channel_id,
-      'channel_type': channel_type,
-      'frequency': frequency,
-      'width': width,
-      'power': power,
-    })
+    stats['upstream'].append(UpstreamChannel(
+      channel_id=channel_id,
+      channel_type=channel_type,
+      frequency=frequency,
+      width=width,
+      power=power,
+    ))
 
   logging.debug('upstream stats: %s', stats['upstream'])
   if not stats['upstream']:
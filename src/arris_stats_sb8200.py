@@ -3,12 +3,34 @@
 """
 # pylint: disable=line-too-long
 
+import re
 import base64
+import hashlib
 import logging
-import requests
-from bs4 import BeautifulSoup
-
-def get_credential(config):
+import functools
+from lxml import html as lxml_html
+from channel_stats import DownstreamChannel, UpstreamChannel
+
+# Unit suffix on the frequency, width, power and SNR cells
+_UNIT_RE = re.compile(r'\s*(Hz|dBmV|dB)\s*$')
+
+# Names the modem uses for downstream modulations / upstream channel types, mapped
+# to the ones we store. Anything not listed here is stored as is.
+_MODULATION_MAP = {
+  'Other': 'OFDM PLC',
+}
+_UPSTREAM_TYPE_MAP = {
+  'SC-QAM Upstream': 'SC-QAM',
+  'OFDM Upstream': 'OFDMA',
+}
+
+# Returned by get_html() when the status page is the same as last time
+NOT_MODIFIED = object()
+
+# ETag and digest of the last status page returned by get_html()
+_last_page = { 'etag': None, 'digest': None }
+
+def get_credential(config, session):
   """ Get the cookie credential by sending the
     username and password pair for basic auth. They
     also want the pair as a base64 encoded get req param
@@ -24,11 +46,7 @@ def get_credential(config):
   password = config['modem_password']
   verify_ssl = config['modem_verify_ssl']
 
-  # We have to send a request with the username and password
-  # encoded as a url param.  Look at the Javascript from the
-  # login page for more info on the following.
-  token = username + ":" + password
-  auth_hash = base64.b64encode(token.encode('ascii')).decode()
+  auth_hash = get_auth_hash(username, password)
 
   if config['modem_new_auth']:
     auth_url = url + '?login_' + auth_hash
@@ -42,20 +60,20 @@ def get_credential(config):
   # have to send as a cookie with subsequent requests
   try:
     if config['modem_new_auth']:
-      resp = requests.get(
+      resp = session.get(
         auth_url,
         headers={'Authorization': 'Basic ' + auth_hash},
         verify=verify_ssl,
-        timeout=config['request_timeout']
+        timeout=(config['modem_connect_timeout'], config['request_timeout'])
       )
       cookie = resp.cookies['sessionId']
       logging.debug('cookie: %s', cookie)
     else:
-      resp = requests.get(
+      resp = session.get(
         auth_url,
         auth=(username, password),
         verify=verify_ssl,
-        timeout=config['request_timeout']
+        timeout=(config['modem_connect_timeout'], config['request_timeout'])
       )
       cookie = None
 
@@ -63,11 +81,9 @@ def get_credential(config):
       logging.error('Error authenticating with %s', url)
       logging.error('Status code: %s', resp.status_code)
       logging.error('Reason: %s', resp.reason)
-      resp.close()
       return None
 
     token = resp.text
-    resp.close()
   except Exception as exception:
     logging.error(exception)
     logging.error('Error authenticating with %s', url)
@@ -80,9 +96,27 @@ def get_credential(config):
   return { 'token': token, 'cookie': cookie }
 
 
-def get_html(config, credential):
+@functools.lru_cache(maxsize=1)
+def get_auth_hash(username, password):
+  """ We have to send a request with the username and password
+    encoded as a url param.  Look at the Javascript from the
+    login page for more info on the following.
+    The credentials don't change while we're running, so this is only worked out once
+  """
+  token = username + ":" + password
+  return base64.b64encode(token.encode('ascii')).decode()
+
+
+def forget_page():
+  """ Forget the last status page, so the next one isn't reported as NOT_MODIFIED """
+  _last_page['etag'] = None
+  _last_page['digest'] = None
+
+
+def get_html(config, credential, session):
   """ Get the status page from the modem
-    return the raw html
+    return the parsed html document, or NOT_MODIFIED if
+    the page hasn't changed since the last call
   """
 
   if config["modem_ssl"]:
@@ -106,78 +140,101 @@ def get_html(config, credential):
   else:
     cookies = None
 
+  if _last_page['etag']:
+    headers = { 'If-None-Match': _last_page['etag'] }
+  else:
+    headers = None
+
   logging.info('Retreiving stats from %s', init_url)
 
   try:
-    resp = requests.get(
+    with session.get(
       url,
       cookies=cookies,
+      headers=headers,
       verify=verify_ssl,
-      timeout=config['request_timeout']
-    )
-    if resp.status_code != 200:
-      logging.error('Error retreiving html from %s', url)
-      logging.error('Status code: %s', resp.status_code)
-      logging.error('Reason: %s', resp.reason)
-      return None
-    status_html = resp.content.decode("utf-8")
-    resp.close()
+      timeout=(config['modem_connect_timeout'], config['request_timeout']),
+      stream=True
+    ) as resp:
+      if resp.status_code == 304:
+        logging.info('Status page not modified since last retrieval')
+        return NOT_MODIFIED
+
+      if resp.status_code != 200:
+        logging.error('Error retreiving html from %s', url)
+        logging.error('Status code: %s', resp.status_code)
+        logging.error('Reason: %s', resp.reason)
+        return None
+
+      # Feed the body to the parser as it arrives rather than holding a copy of
+      # the raw bytes and the decoded string as well as the parsed document
+      parser = lxml_html.HTMLParser(encoding='utf-8')
+      digest = hashlib.blake2b(digest_size=16)
+      for chunk in resp.iter_content(8192):
+        parser.feed(chunk)
+        digest.update(chunk)
+      status_html = parser.close()
+      etag = resp.headers.get('ETag')
   except Exception as exception:
     logging.error(exception)
     logging.error('Error retreiving html from %s', url)
     return None
 
-  if 'Password:' in status_html:
+  if 'Password:' in status_html.text_content():
     logging.error('Authentication error, received login page.')
     if not config['modem_auth_required']:
       logging.warning('You have modem_auth_required to False, but a login page was detected!')
     return None
 
+  # Most firmwares don't send an ETag, so fall back to comparing the page itself
+  _last_page['etag'] = etag
+  digest = digest.digest()
+  if digest == _last_page['digest']:
+    logging.info('Status page unchanged since last retrieval')
+    return NOT_MODIFIED
+  _last_page['digest'] = digest
+
   return status_html
 
 
 def parse_html(html):
-  """ Parse the HTML into the modem stats dict """
+  """ Parse the HTML (raw or already parsed by get_html()) into the modem stats dict """
   logging.info('Parsing HTML for modem model sb8200')
 
-  # As of Aug 2019 the SB8200 has a bug in its HTML
-  # The tables have an extra </tr> in the table headers, we have to remove it so
-  # that Beautiful Soup can parse it
-  # Before: <tr><th colspan=7><strong>Upstream Bonded Channels</strong></th></tr>
-  # After: <tr><th colspan=7><strong>Upstream Bonded Channels</strong></th>
-  html = html.replace('Bonded Channels</strong></th></tr>', 'Bonded Channels</strong></th>', 2)
-
-  soup = BeautifulSoup(html, 'html.parser')
+  # As of Aug 2019 the SB8200 has a bug in its HTML, the tables have an extra </tr>
+  # in the table headers. libxml2's HTML parser drops the stray end tag itself, so
+  # unlike with Beautiful Soup the html doesn't need to be cleaned up first.
+  if isinstance(html, str):
+    doc = lxml_html.fromstring(html)
+  else:
+    doc = html
+  tables = doc.xpath('//table')
   stats = {}
 
   # downstream table
   stats['downstream'] = []
-  for table_row in soup.find_all("table")[1].find_all("tr"):
-    if table_row.th:
-      continue
+  for table_row in tables[1].xpath('.//tr[not(.//th)]'):
+    cells = [td.text_content().strip() for td in table_row.findall('td')]
 
-    channel_id = table_row.find_all('td')[0].text.strip()
-
-    # Some firmwares have a header row not already skiped by "if table_row.th", skip it if channel_id isn't an integer
-    if not channel_id.isdigit():
+    # Some firmwares have a header row not already skiped by "tr[not(.//th)]", skip it if channel_id isn't an integer
+    if len(cells) < 8 or not cells[0].isdigit():
       continue
 
-    modulation = table_row.find_all('td')[2].text.replace("Other", "OFDM PLC").strip()
-    frequency = table_row.find_all('td')[3].text.replace(" Hz", "").strip()
-    power = table_row.find_all('td')[4].text.replace(" dBmV", "").strip()
-    snr = table_row.find_all('td')[5].text.replace(" dB", "").strip()
-    corrected = table_row.find_all('td')[6].text.strip()
-    uncorrectables = table_row.find_all('td')[7].text.strip()
-
-    stats['downstream'].append({
-      'channel_id': channel_id,
-      'modulation': modulation,
-      'frequency': frequency,
-      'power': power,
-      'snr': snr,
-      'corrected': corrected,
-      'uncorrectables': uncorrectables
-    })
+    channel_id, _, modulation, frequency, power, snr, corrected, uncorrectables = cells[:8]
+    modulation = _MODULATION_MAP.get(modulation, modulation)
+    frequency = _UNIT_RE.sub('', frequency)
+    power = _UNIT_RE.sub('', power)
+    snr = _UNIT_RE.sub('', snr)
+
+    stats['downstream'].append(DownstreamChannel(
+      channel_id=channel_id,
+      modulation=modulation,
+      frequency=frequency,
+      power=power,
+      snr=snr,
+      corrected=corrected,
+      uncorrectables=uncorrectables
+    ))
 
   logging.debug('downstream stats: %s', stats['downstream'])
   if not stats['downstream']:
@@ -185,27 +242,26 @@ def parse_html(html):
 
   # upstream table
   stats['upstream'] = []
-  for table_row in soup.find_all("table")[2].find_all("tr"):
-    if table_row.th:
-      continue
+  for table_row in tables[2].xpath('.//tr[not(.//th)]'):
+    cells = [td.text_content().strip() for td in table_row.findall('td')]
 
-    # Some firmwares have a header row not already skiped by "if table_row.th", skip it if channel_id isn't an integer
-    if not channel_id.isdigit():
+    # Some firmwares have a header row not already skiped by "tr[not(.//th)]", skip it if channel_id isn't an integer
+    if len(cells) < 7 or not cells[1].isdigit():
       continue
 
-    channel_id = table_row.find_all('td')[1].text.strip()
-    channel_type = table_row.find_all('td')[3].text.replace(" Upstream", "").replace("OFDM", "OFDMA").strip()
-    frequency = table_row.find_all('td')[4].text.replace(" Hz", "").strip()
-    width = table_row.find_all('td')[5].text.replace(" Hz", "").strip()
-    power = table_row.find_all('td')[6].text.replace(" dBmV", "").strip()
-
-    stats['upstream'].append({
-      'channel_id': channel_id,
-      'channel_type': channel_type,
-      'frequency': frequency,
-      'width': width,
-      'power': power,
-    })
+    _, channel_id, _, channel_type, frequency, width, power = cells[:7]
+    channel_type = _UPSTREAM_TYPE_MAP.get(channel_type, channel_type)
+    frequency = _UNIT_RE.sub('', frequency)
+    width = _UNIT_RE.sub('', width)
+    power = _UNIT_RE.sub('', power)
+
+    stats['upstream'].append(UpstreamChannel(
+      channel_id=channel_id,
+      channel_type=channel_type,
+      frequency=frequency,
+      width=width,
+      power=power,
+    ))
 
   logging.debug('upstream stats: %s', stats['upstream'])
   if not stats['upstream']:
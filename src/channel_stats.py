@@ -0,0 +1,27 @@
+"""
+  Channel records returned by the modem parsers
+"""
+
+from dataclasses import dataclass
+
+@dataclass(slots=True)
+class DownstreamChannel:
+  """ Stats for one downstream channel """
+  channel_id: str
+  modulation: str
+  frequency: str
+  power: str
+  snr: str
+  corrected: str
+  uncorrectables: str
+  # Only some modems, like the XB8, have the 'unerrored' value
+  unerrored: str | None = None
+
+@dataclass(slots=True)
+class UpstreamChannel:
+  """ Stats for one upstream channel """
+  channel_id: str
+  channel_type: str
+  frequency: str
+  width: str
+  power: str
@@ -4,10 +4,10 @@
 # pylint: disable=line-too-long
 
 import logging
-import requests
 from bs4 import BeautifulSoup
+from channel_stats import DownstreamChannel, UpstreamChannel
 
-def get_credential(config):
+def get_credential(config, session):
   """ Get the cookie credential by posting the
     username and password.
   """
@@ -24,11 +24,11 @@ def get_credential(config):
   }
 
   try:
-    resp = requests.post(
+    resp = session.post(
       url,
       data=data,
       allow_redirects=False,
-      timeout=config['request_timeout']
+      timeout=(config['modem_connect_timeout'], config['request_timeout'])
     )
     cookies = resp.cookies
 
@@ -47,7 +47,7 @@ def get_credential(config):
 
   return cookies
 
-def get_html(config, cookies):
+def get_html(config, cookies, session):
   """ Get the status page from the modem
     return the raw html
   """
@@ -57,7 +57,7 @@ def get_html(config, cookies):
   logging.info('Retreiving stats from %s', url)
 
   try:
-    resp = requests.get(url, cookies=cookies, timeout=config['request_timeout'])
+    resp = session.get(url, cookies=cookies, timeout=(config['modem_connect_timeout'], config['request_timeout']))
     if resp.status_code != 200:
       logging.error('Error retreiving html from %s', url)
       logging.error('Status code: %s', resp.status_code)
@@ -100,6 +100,8 @@ def parse_html(html):
       channel['modulation'] = "OFDM PLC"
     elif modulation == "256 QAM":
       channel['modulation'] = "QAM256"
+    else:
+      channel['modulation'] = modulation
 
     frequency = downstream_rows[2].find_all("td")[i].text.strip()
     if "MHz" in frequency:
@@ -126,7 +128,7 @@ def parse_html(html):
   logging.debug('downstream stats: %s', stats['downstream'])
 
   # Convert downstream dictionary format to expected array format
-  stats['downstream'] = stats['downstream'].values()
+  stats['downstream'] = [DownstreamChannel(**channel) for channel in stats['downstream'].values()]
 
   # Upstream table
   upstream_rows = soup.find_all("table")[1].find('tbody').find_all("tr")
@@ -151,7 +153,7 @@ def parse_html(html):
     else:
       channel['channel_type'] = channel_type
 
-    stats['upstream'].append(channel)
+    stats['upstream'].append(UpstreamChannel(**channel))
 
   logging.debug('upstream stats: %s', stats['upstream'])
   if not stats['upstream']: